@@ -54,10 +54,14 @@ import boto3
 from collections import defaultdict
 from copy import deepcopy
 from datetime import date, datetime
+import fnmatch
+import glob
+import hashlib
 import json
 import os
 import re
 import sys
+import tempfile
 from time import time
 import yaml
 
@@ -83,6 +87,7 @@ DEFAULTS = {
         'enable_caching': False,
         'cache_path': '~/.ansible/tmp',
         'cache_max_age': 300,
+        'cache_max_age_regions': {},
         'nested_groups': True,
         'replace_dash_in_groups': True,
         'group_by_instance_id': False,
@@ -135,6 +140,15 @@ class Ec2Inventory(object):
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Inventory and index of each region, keyed by region
+        self.shards = {}
+
+        # Modification time of each region's cache shard used in this run
+        self.shard_mtimes = {}
+
+        # Index of group name to every host in the group and its children
+        self.group_index = {}
+
         # Boto profile to use (if any)
         self.boto_profile = None
 
@@ -145,18 +159,19 @@ class Ec2Inventory(object):
         self.parse_cli_args()
         self.read_settings()
 
-        # Update Inventory
-        self.update_inventory()
+        # Update Inventory, unless the subset query can be served from the cache
+        self.subset_output = self.get_subset_from_cache() if self.args.subset else None
+        if self.subset_output is None:
+            self.update_inventory()
 
         # Data to print
         if self.args.host:
             data_to_print = self.get_host_info()
+        elif self.args.subset:
+            data_to_print = self.get_subset_info()
         elif self.args.list:
             # Display list of instances for inventory
-            if self.inventory == self._empty_inventory() and self.settings['enable_caching']:
-                data_to_print = self.get_inventory_from_cache()
-            else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+            data_to_print = self.json_format_dict(self.inventory, True)
 
         print(data_to_print)
 
@@ -168,8 +183,12 @@ class Ec2Inventory(object):
                             help='List instances (default: True)')
         parser.add_argument('--host', action='store',
                             help='Get all the variables about a specific instance')
+        parser.add_argument('--subset', action='store',
+                            help='Only list the hosts matching a group pattern such as "web:&prod:!staging"')
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                             help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+        parser.add_argument('--region', action='store',
+                            help='Only rebuild the cache shard of this region (requires --refresh-cache and enable_caching)')
         parser.add_argument('--profile', '--boto-profile', action='store', dest='boto_profile',
                             help='Use boto profile for connections to EC2')
         parser.add_argument('--config-file', action='store', dest='config_file',
@@ -251,37 +270,171 @@ class Ec2Inventory(object):
             if not os.path.exists(cache_dir):
                 os.makedirs(cache_dir)
             
+            # Name the cache after every source of credentials so that
+            # different accounts never share cache shards
             cache_name = 'ansible-ec2'
-            cache_id = self.boto_profile or os.environ.get('AWS_ACCESS_KEY_ID', self.credentials.get('aws_access_key_id'))
+            cache_ids = [
+                self.boto_profile or os.environ.get('AWS_PROFILE'),
+                os.environ.get('AWS_ACCESS_KEY_ID', self.credentials.get('aws_access_key_id')),
+                self.settings.get('iam_assume_role')
+            ]
+            cache_id = '|'.join(cache_id for cache_id in cache_ids if cache_id)
             if cache_id:
-                cache_name = '%s-%s' % (cache_name, cache_id)
-            cache_name += '-' + str(abs(hash(__file__)))[1:7]
-            self.cache_path_cache = os.path.join(cache_dir, "%s.cache" % cache_name)
-            self.cache_path_index = os.path.join(cache_dir, "%s.index" % cache_name)
+                cache_name = '%s-%s' % (cache_name, hashlib.md5(cache_id.encode('utf-8')).hexdigest()[:12])
+            # hash() is salted per process, so it cannot be used to name files
+            # that need to be found again on the next run
+            cache_name += '-' + hashlib.md5(__file__.encode('utf-8')).hexdigest()[:6]
+            # Each region is cached in its own shard named after this prefix
+            self.cache_path_prefix = os.path.join(cache_dir, cache_name)
+
+        if self.args.region and not (self.args.refresh_cache and self.settings['enable_caching']):
+            self.fail_with_error('--region can only be used with --refresh-cache when enable_caching is set')
+        if self.args.region and self.args.region not in self.settings['regions']:
+            self.fail_with_error('Region %s is not in the configured regions' % self.args.region)
 
 
-    def is_cache_valid(self):
-        ''' Determines if the cache files have expired, or if it is still valid '''
+    def get_shard_paths(self, region):
+        ''' Returns the cache and index file paths of a region's cache shard '''
+        shard_name = '%s-%s' % (self.cache_path_prefix, region)
+        return ("%s.cache" % shard_name, "%s.index" % shard_name)
 
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
+
+    def get_shard_max_age(self, region):
+        ''' Returns the number of seconds a region's cache shard is valid for,
+        preferring a per-region override over cache_max_age '''
+        region_max_age = self.settings.get('cache_max_age_regions') or {}
+        return region_max_age.get(region, self.settings['cache_max_age'])
+
+
+    def is_cache_valid(self, region):
+        ''' Determines if the cache shard of a region has expired, or if it is
+        still valid '''
+        cache_path, index_path = self.get_shard_paths(region)
+
+        if os.path.isfile(cache_path):
+            mod_time = os.path.getmtime(cache_path)
             current_time = time()
-            if (mod_time + self.settings['cache_max_age']) > current_time:
-                if os.path.isfile(self.cache_path_index):
+            if (mod_time + self.get_shard_max_age(region)) > current_time:
+                if os.path.isfile(index_path):
                     return True
 
         return False
 
 
+    def get_subset_cache_path(self):
+        ''' Returns the path of the cache file holding the output of the
+        --subset query. The path depends on the regions and settings too, so
+        different configs never share the output '''
+        settings_json = json.dumps(self.settings, sort_keys=True, default=str)
+        query = '\n'.join([
+            'yaml' if self.args.yaml else 'json',
+            ','.join(sorted(self.settings['regions'])),
+            hashlib.md5(settings_json.encode('utf-8')).hexdigest(),
+            self.args.subset
+        ])
+        query_id = hashlib.md5(query.encode('utf-8')).hexdigest()[:12]
+        return '%s-subset-%s.cache' % (self.cache_path_prefix, query_id)
+
+
+    def purge_subset_cache(self):
+        ''' Deletes the cached output of every --subset query, which is no
+        longer valid once a shard is rewritten '''
+        pattern = '%s-subset-*.cache' % glob.escape(self.cache_path_prefix)
+        for subset_path in glob.glob(pattern):
+            try:
+                os.remove(subset_path)
+            except OSError:
+                # Another run may have deleted it already
+                pass
+
+
+    def get_subset_from_cache(self):
+        ''' Returns the cached output of the --subset query, or None if it is
+        missing or no longer valid. The first line of the file holds the
+        modification times of the shards the output was built from, which
+        must all still match shards that are valid '''
+        if not self.settings['enable_caching'] or self.args.refresh_cache:
+            return None
+
+        try:
+            with open(self.get_subset_cache_path(), 'r') as f:
+                shard_mtimes = json.loads(f.readline())
+                output = f.read()
+        except (ValueError, IOError):
+            return None
+
+        for region in self.settings['regions']:
+            if not self.is_cache_valid(region):
+                return None
+            if shard_mtimes.get(region) != os.path.getmtime(self.get_shard_paths(region)[0]):
+                return None
+
+        return output
+
+
+    def needs_refresh(self, region):
+        ''' Determines if a region has to be fetched from the API instead of
+        being read from its cache shard '''
+        if not self.settings['enable_caching']:
+            return True
+        if self.args.refresh_cache and self.args.region in (None, region):
+            return True
+        return not self.is_cache_valid(region)
+
+
     def update_inventory(self):
-        ''' Do API calls to each region, and save data in cache files '''
+        ''' Do API calls to each region whose cache shard is missing or expired,
+        save them in their shards and merge every region into the inventory '''
         for region in self.settings['regions']:
-            self.get_instances(region)
+            region_inventory = None
+            if not self.needs_refresh(region):
+                try:
+                    region_inventory, region_index = self.get_inventory_from_cache(region)
+                except (ValueError, IOError):
+                    # The shard is unreadable, fetch the region again
+                    region_inventory = None
+
+            if region_inventory is None:
+                # Build the region on its own so it can be written as a shard
+                self.inventory = self._empty_inventory()
+                self.index = {}
+                self.get_instances(region)
+
+                # Pass the region through JSON so hostvars (e.g. datetimes)
+                # look the same whether the region was fetched or cached
+                region_json = json.dumps(self.inventory, default=self._json_serial)
+                region_inventory, region_index = json.loads(region_json), self.index
+
+                if self.settings['enable_caching']:
+                    # The index is written first since the cache file's
+                    # timestamp decides whether the shard is valid
+                    cache_path, index_path = self.get_shard_paths(region)
+                    self.write_to_cache(region_index, index_path)
+                    self.shard_mtimes[region] = self.write_file_atomically(region_json, cache_path)
+                    self.purge_subset_cache()
+
+            self.shards[region] = (region_inventory, region_index)
 
-        if self.settings['enable_caching']:
-            if self.args.refresh_cache or not self.is_cache_valid():
-                self.write_to_cache(self.inventory, self.cache_path_cache)
-                self.write_to_cache(self.index, self.cache_path_index)
+        self.inventory = self._empty_inventory()
+        self.index = {}
+        for region in self.settings['regions']:
+            self.merge_inventory(*self.shards[region])
+
+
+    def merge_inventory(self, inventory, index):
+        ''' Merges a region's inventory and index into self.inventory and
+        self.index '''
+        self.index.update(index)
+
+        for group, data in inventory.items():
+            if group == '_meta':
+                self.inventory['_meta']['hostvars'].update(data['hostvars'])
+                continue
+            for host in data['hosts']:
+                self.push(self.inventory, group, host)
+            for child in data['children']:
+                self.push_group(self.inventory, group, child)
+            self.inventory[group]['vars'].update(data['vars'])
 
 
     def get_aws_connection(self, aws_service, region="us-east-1"):
@@ -617,6 +770,114 @@ class Ec2Inventory(object):
         return self.json_format_dict(instance, True)
 
 
+    def get_subset_info(self):
+        ''' Get the groups, hosts and hostvars matching the --subset query '''
+        subset_path = self.settings['enable_caching'] and self.get_subset_cache_path()
+
+        if self.subset_output is not None:
+            return self.subset_output
+
+        data = self.json_format_dict(self.get_subset(self.args.subset), True)
+        if subset_path:
+            header = json.dumps(self.shard_mtimes, sort_keys=True)
+            self.write_file_atomically('%s\n%s' % (header, data), subset_path)
+        return data
+
+
+    def get_subset(self, expression):
+        ''' Returns an inventory containing only the hosts matching the group
+        expression, the groups they belong to and their hostvars '''
+        self.build_group_index()
+        hosts = self.resolve_subset(expression)
+        subset = self._empty_inventory()
+
+        for group, data in self.inventory.items():
+            if group == '_meta':
+                continue
+            group_hosts = [host for host in data['hosts'] if host in hosts]
+            if group_hosts:
+                subset[group] = {'hosts': group_hosts, 'vars': data['vars'], 'children': []}
+
+        # Keep the parents of the selected groups so nested groups still resolve
+        changed = True
+        while changed:
+            changed = False
+            for group, data in self.inventory.items():
+                if group == '_meta':
+                    continue
+                children = [child for child in data['children'] if child in subset]
+                if children and (group not in subset or subset[group]['children'] != children):
+                    if group not in subset:
+                        subset[group] = {'hosts': [], 'vars': data['vars'], 'children': []}
+                    subset[group]['children'] = children
+                    changed = True
+
+        for host in hosts:
+            subset['_meta']['hostvars'][host] = self.inventory['_meta']['hostvars'][host]
+
+        return subset
+
+
+    def resolve_subset(self, expression):
+        ''' Resolves a group expression to a set of hosts. Like Ansible limit
+        patterns, terms are separated by ':' or ',' and can be prefixed with
+        '&' for an intersection or '!' for an exclusion '''
+        terms = [term.strip() for term in re.split(r'[:,]', expression) if term.strip()]
+        unions = [term for term in terms if term[0] not in '&!']
+
+        if unions:
+            hosts = set()
+            for term in unions:
+                hosts |= self.match_pattern(term)
+        else:
+            hosts = self.match_pattern('all')
+
+        for term in terms:
+            if term[0] == '&':
+                hosts &= self.match_pattern(term[1:])
+        for term in terms:
+            if term[0] == '!':
+                hosts -= self.match_pattern(term[1:])
+
+        return hosts
+
+
+    def match_pattern(self, pattern):
+        ''' Returns the set of hosts matching a group or host name, which may
+        contain shell-style wildcards '''
+        hostvars = self.inventory['_meta']['hostvars']
+        if pattern in ('all', '*'):
+            return set(hostvars)
+
+        hosts = set()
+        for group in fnmatch.filter(self.group_index, pattern):
+            hosts |= self.group_index[group]
+        hosts.update(fnmatch.filter(hostvars, pattern))
+        return hosts
+
+
+    def build_group_index(self):
+        ''' Sets self.group_index to map each group to the hosts it contains
+        directly or through its children '''
+        self.group_index = {}
+        for group in self.inventory:
+            if group != '_meta':
+                self.resolve_group(group)
+
+
+    def resolve_group(self, group):
+        ''' Returns the set of hosts in a group and its children '''
+        if group not in self.group_index:
+            # Mark the group before visiting children to guard against cycles
+            self.group_index[group] = set()
+            data = self.inventory.get(group, {})
+            hosts = set(data.get('hosts', []))
+            for child in data.get('children', []):
+                hosts |= self.resolve_group(child)
+            self.group_index[group] = hosts
+        return self.group_index[group]
+
+
     def get_instance(self, region, instance_id):
         ''' Get specific instanc(s) given a list of instance Ids '''
         conn = self.get_aws_connection('ec2', region)
@@ -625,41 +886,63 @@ class Ec2Inventory(object):
             for instance in reservation['Instances']:
                 return instance
 
-    
-    def is_cache_valid(self):
-        ''' Determines if the cache files have expired, or if it is still valid '''
-
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
-            current_time = time()
-            if (mod_time + self.settings['cache_max_age']) > current_time:
-                if os.path.isfile(self.cache_path_index):
-                    return True
-
-        return False
 
     def load_index_from_cache(self):
-        ''' Reads the index from the cache file sets self.index '''
-        with open(self.cache_path_index, 'rb') as f:
-            self.index = json.load(f)
-
-
-    def get_inventory_from_cache(self):
-        ''' Reads the inventory from the cache file and returns it as a JSON
-        object '''
-        with open(self.cache_path_cache, 'r') as f:
+        ''' Reads the index from every region's cache shard and sets
+        self.index '''
+        self.index = {}
+        if not self.settings['enable_caching']:
+            return
+        for region in self.settings['regions']:
+            index_path = self.get_shard_paths(region)[1]
             try:
-                yaml_inventory = yaml.safe_load(f)
-                return yaml_inventory
-            except:
-                json_inventory = f.read()
-                return json_inventory    
+                with open(index_path, 'r') as f:
+                    self.index.update(json.load(f))
+            except (ValueError, IOError):
+                # Missing or unreadable shards are left out of the index
+                continue
+
+
+    def get_inventory_from_cache(self, region):
+        ''' Reads the inventory and index of a region from its cache shard and
+        returns them as dicts '''
+        cache_path, index_path = self.get_shard_paths(region)
+        with open(cache_path, 'r') as f:
+            # Take the timestamp of the file actually read, in case another
+            # run replaces the shard meanwhile
+            self.shard_mtimes[region] = os.fstat(f.fileno()).st_mtime
+            inventory = json.load(f)
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        return (inventory, index)
+
 
     def write_to_cache(self, data, filename):
         ''' Writes data in JSON format to a file '''
-        json_data = self.json_format_dict(data, True)
-        with open(filename, 'w+') as f:
-            f.write(json_data)
+        json_data = json.dumps(data, default=self._json_serial)
+        self.write_file_atomically(json_data, filename)
+
+
+    def write_file_atomically(self, text, filename):
+        ''' Writes text to a temporary file next to filename and moves it into
+        place, so readers never see a partially written file. Returns the
+        modification time of the written file '''
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        try:
+            # mkstemp creates the file as 0600, give it the usual umask
+            # based permissions so a shared cache directory stays readable
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+                f.flush()
+                mtime = os.fstat(f.fileno()).st_mtime
+            os.replace(tmp_path, filename)
+            return mtime
+        except:
+            os.remove(tmp_path)
+            raise
 
 
     def json_format_dict(self, data, pretty=False):